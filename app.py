@@ -1,81 +1,220 @@
-import json
-import struct
+import functools
+import hashlib
+import logging
+import math
+import queue
+import threading
+import time
+import orjson
 import pyodbc
 import os
+import re
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
 
+from cachetools import TTLCache
 from flask import Flask, request, jsonify
+from flask.json.provider import DefaultJSONProvider
 from azure.identity import ClientSecretCredential
 from openai import AzureOpenAI
 from dotenv import load_dotenv
 
 load_dotenv()
 
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper())
+logger = logging.getLogger(__name__)
+
+# ---------------- JSON ----------------
+# orjson for request/response bodies. Dates, Decimals and UUIDs still go
+# through Flask's default hook, and keys are sorted when sort_keys is set
+# (Flask's default), so the response format is unchanged.
+class OrjsonProvider(DefaultJSONProvider):
+    @property
+    def option(self):
+        option = orjson.OPT_PASSTHROUGH_DATETIME
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return option
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=self.option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, default=self.default, option=self.option),
+            mimetype=self.mimetype
+        )
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 # ---------------- DB CONNECTION ----------------
-def get_db_connection():
-    credential = ClientSecretCredential(
-        tenant_id=os.getenv("AZURE_TENANT_ID"),
-        client_id=os.getenv("AZURE_CLIENT_ID"),
-        client_secret=os.getenv("AZURE_CLIENT_SECRET")
-    )
-
-    token = credential.get_token(
-        "https://database.windows.net/.default"
-    ).token
-
-    SQL_COPT_SS_ACCESS_TOKEN = 1256
-    token_bytes = token.encode("UTF-16-LE")
-    token_struct = struct.pack(
-        f"<I{len(token_bytes)}s",
-        len(token_bytes),
-        token_bytes
-    )
-
-    conn_str = (
-        "Driver={ODBC Driver 18 for SQL Server};"
-        f"Server=tcp:{os.getenv('DB_SERVER')},1433;"
-        f"Database={os.getenv('DB_NAME')};"
-        "Encrypt=yes;"
-        "TrustServerCertificate=yes;"
-        "Connection Timeout=30;"
-    )
+# Let the ODBC Driver Manager pool handles, and keep our own pool of open
+# connections so requests skip the TLS/TDS handshake to Azure SQL.
+pyodbc.pooling = True
+
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+# Pooled connections idle longer than this are likely dropped by the Azure
+# SQL gateway, so they are closed instead of being handed out.
+DB_POOL_IDLE_SECONDS = int(os.getenv("DB_POOL_IDLE_SECONDS", "300"))
+_DB_POOL = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+
+SQL_COPT_SS_ACCESS_TOKEN = 1256
+TOKEN_REFRESH_MARGIN_SECONDS = 300
+
+_TOKEN_CACHE = {"credential": None, "struct": None, "exp": 0}
+_TOKEN_LOCK = threading.Lock()
+
+def get_token_struct():
+    with _TOKEN_LOCK:
+        if time.time() < _TOKEN_CACHE["exp"] - TOKEN_REFRESH_MARGIN_SECONDS:
+            return _TOKEN_CACHE["struct"]
+
+        if _TOKEN_CACHE["credential"] is None:
+            _TOKEN_CACHE["credential"] = ClientSecretCredential(
+                tenant_id=os.getenv("AZURE_TENANT_ID"),
+                client_id=os.getenv("AZURE_CLIENT_ID"),
+                client_secret=os.getenv("AZURE_CLIENT_SECRET")
+            )
+
+        access_token = _TOKEN_CACHE["credential"].get_token(
+            "https://database.windows.net/.default"
+        )
+
+        token_bytes = access_token.token.encode("UTF-16-LE")
+        _TOKEN_CACHE["struct"] = (
+            len(token_bytes).to_bytes(4, "little") + token_bytes
+        )
+        _TOKEN_CACHE["exp"] = access_token.expires_on
+        return _TOKEN_CACHE["struct"]
+
+CONN_STR = (
+    "Driver={ODBC Driver 18 for SQL Server};"
+    f"Server=tcp:{os.getenv('DB_SERVER')},1433;"
+    f"Database={os.getenv('DB_NAME')};"
+    "Encrypt=yes;"
+    "TrustServerCertificate=yes;"
+    "Connection Timeout=30;"
+)
 
+def get_db_connection():
     return pyodbc.connect(
-        conn_str,
-        attrs_before={SQL_COPT_SS_ACCESS_TOKEN: token_struct}
+        CONN_STR,
+        attrs_before={SQL_COPT_SS_ACCESS_TOKEN: get_token_struct()}
     )
 
+def _close_quietly(conn):
+    try:
+        conn.close()
+    except pyodbc.Error:
+        pass
+
+def acquire_db_connection():
+    while True:
+        try:
+            conn, last_used = _DB_POOL.get_nowait()
+        except queue.Empty:
+            return get_db_connection()
+
+        if time.monotonic() - last_used < DB_POOL_IDLE_SECONDS:
+            return conn
+        _close_quietly(conn)
+
+def release_db_connection(conn, reusable=True):
+    if reusable:
+        try:
+            conn.rollback()
+            _DB_POOL.put_nowait((conn, time.monotonic()))
+            return
+        except (pyodbc.Error, queue.Full):
+            pass
+
+    _close_quietly(conn)
+
 # ---------------- SCHEMA ----------------
 def get_schema_info(cursor):
     schema_info = {}
     cursor.execute("""
-        SELECT TABLE_SCHEMA, TABLE_NAME
-        FROM INFORMATION_SCHEMA.TABLES
-        WHERE TABLE_TYPE='BASE TABLE'
+        SELECT c.TABLE_SCHEMA, c.TABLE_NAME, c.COLUMN_NAME, c.DATA_TYPE
+        FROM INFORMATION_SCHEMA.COLUMNS c
+        JOIN INFORMATION_SCHEMA.TABLES t
+            ON t.TABLE_SCHEMA = c.TABLE_SCHEMA
+            AND t.TABLE_NAME = c.TABLE_NAME
+        WHERE t.TABLE_TYPE='BASE TABLE'
+        ORDER BY c.TABLE_SCHEMA, c.TABLE_NAME, c.ORDINAL_POSITION
     """)
 
-    for schema, table in cursor.fetchall():
-        cursor.execute("""
-            SELECT COLUMN_NAME, DATA_TYPE
-            FROM INFORMATION_SCHEMA.COLUMNS
-            WHERE TABLE_SCHEMA=? AND TABLE_NAME=?
-        """, (schema, table))
-
-        schema_info[f"{schema}.{table}"] = [
-            {"name": c[0], "type": c[1]} for c in cursor.fetchall()
-        ]
+    for schema, table, column, data_type in cursor.fetchall():
+        schema_info.setdefault(f"{schema}.{table}", []).append(
+            {"name": column, "type": data_type}
+        )
     return schema_info
 
+# Schema changes rarely, so introspection results are kept per process
+# and refreshed after SCHEMA_TTL_SECONDS.
+SCHEMA_TTL_SECONDS = 300
+_SCHEMA_CACHE = {"ts": 0, "data": None, "json": None, "hash": None}
+_SCHEMA_LOCK = threading.Lock()
+
+# Only the tables the system prompt describes are sent to the LLM; the rest
+# of INFORMATION_SCHEMA just inflates input tokens. Set SCHEMA_TABLES to an
+# empty string to send everything.
+SCHEMA_TABLES = {
+    t.strip().lower()
+    for t in os.getenv("SCHEMA_TABLES", "dbo.itemledgerentries,dbo.items").split(",")
+    if t.strip()
+}
+
+def filter_schema(schema_info):
+    if not SCHEMA_TABLES:
+        return schema_info
+    filtered = {
+        table: columns for table, columns in schema_info.items()
+        if table.lower() in SCHEMA_TABLES
+    }
+    # Fall back to the full schema rather than sending an empty one.
+    return filtered or schema_info
+
+def get_cached_schema(cursor):
+    with _SCHEMA_LOCK:
+        if (
+            _SCHEMA_CACHE["data"] is not None
+            and time.monotonic() - _SCHEMA_CACHE["ts"] < SCHEMA_TTL_SECONDS
+        ):
+            return _SCHEMA_CACHE["json"], _SCHEMA_CACHE["hash"]
+
+        schema_info = filter_schema(get_schema_info(cursor))
+        _SCHEMA_CACHE["data"] = schema_info
+        # Compact, key-sorted output keeps the prompt byte-stable.
+        _SCHEMA_CACHE["json"] = orjson.dumps(
+            schema_info, option=orjson.OPT_SORT_KEYS
+        ).decode()
+        # Fingerprint computed once per refresh; used to namespace the
+        # semantic and prompt caches.
+        _SCHEMA_CACHE["hash"] = hashlib.blake2b(
+            _SCHEMA_CACHE["json"].encode(), digest_size=16
+        ).hexdigest()
+        _SCHEMA_CACHE["ts"] = time.monotonic()
+        return _SCHEMA_CACHE["json"], _SCHEMA_CACHE["hash"]
+
 # ---------------- SQL GENERATION ----------------
-def generate_sql(question, schema_info):
-    client = AzureOpenAI(
+# One client per process so calls share its keep-alive connection pool.
+@functools.lru_cache(maxsize=1)
+def get_openai_client():
+    return AzureOpenAI(
         api_key=os.getenv("AZURE_OPENAI_KEY"),
         api_version="2024-12-01-preview",
         azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT")
     )
 
-    system_prompt = f"""
+# Kept byte-identical across requests so Azure OpenAI's automatic prompt
+# prefix caching can reuse the system prompt and schema.
+SYSTEM_PROMPT = """
 You are an expert SQL query generator for a warehouse management system. Your role is to generate accurate SQL queries based on user questions about sales, inventory, and purchases.
 
 **DATABASE SCHEMA:**
@@ -129,36 +268,240 @@ You are an expert SQL query generator for a warehouse management system. Your ro
 - "Stock of [item] for [year]" → JOIN + appropriate entryType IN + filter displayName + year filter
 
 Generate precise SQL queries following these exact patterns.
-    """
-
-    user_prompt = f"""
-Schema: {json.dumps(schema_info)}
-Question: {question}
-Return only a valid Fabric SQL query. No markdown.
 """
 
+# generate_sql runs at temperature 0, so identical prompts yield identical SQL.
+_PROMPT_CACHE = TTLCache(maxsize=10_000, ttl=3600)
+_PROMPT_CACHE_LOCK = threading.Lock()
+
+# Markdown code fences (```sql / ```SQL / ```) and stray backticks.
+_FENCE_RE = re.compile(r"```(?:sql)?|`", re.IGNORECASE)
+
+# Canonical question shapes from the system prompt are answered from local
+# templates without calling the LLM. Stock questions are left to the LLM
+# because the entryType set depends on whether the item is a finished good
+# or a raw material.
+_QUESTION_PREFIX = r"(?:what (?:is|was|were) (?:the )?)?"
+_TEMPLATES = [
+    (
+        re.compile(_QUESTION_PREFIX + r"total sales (?:for|in) (\d{4})\??", re.IGNORECASE),
+        """SELECT SUM(ile.salesAmountActual) AS totalSales
+FROM [dbo].[itemledgerentries] ile
+WHERE ile.entryType = 'Sale'
+  AND YEAR(ile.postingDate) = {year}"""
+    ),
+    (
+        re.compile(_QUESTION_PREFIX + r"(?:total )?sales of (.+?) (?:for|in) (\d{4})\??", re.IGNORECASE),
+        """SELECT i.displayName, SUM(ile.salesAmountActual) AS totalSales
+FROM [dbo].[itemledgerentries] ile
+JOIN [dbo].[items] i ON i.number = ile.itemNumber
+WHERE ile.entryType = 'Sale'
+  AND i.displayName = ?
+  AND YEAR(ile.postingDate) = {year}
+GROUP BY i.displayName"""
+    ),
+    (
+        re.compile(_QUESTION_PREFIX + r"(?:total )?quantity purchased (?:for|in) (\d{4})\??", re.IGNORECASE),
+        """SELECT SUM(ile.quantity) AS totalQuantity
+FROM [dbo].[itemledgerentries] ile
+WHERE ile.entryType = 'Purchase'
+  AND YEAR(ile.postingDate) = {year}"""
+    ),
+]
+
+# An item capture that itself contains "for/in <year>" means the question
+# asks about several years ("sales of A for 2022 and B for 2023"); list and
+# quantifier words mean it names several items or none ("all items",
+# "top 5 items", "A and B"). Those go to the LLM.
+_NESTED_YEAR_RE = re.compile(r"\b(?:for|in) \d{4}\b", re.IGNORECASE)
+_NOT_AN_ITEM_RE = re.compile(
+    r",|\b(?:and|or|all|any|both|each|every|items|top \d+)\b", re.IGNORECASE
+)
+
+# Returns (sql, params) for a canonical question, or None. The year is
+# formatted in as an int; the item name is bound as a parameter.
+def match_template(question):
+    question = question.strip()
+    for pattern, template in _TEMPLATES:
+        match = pattern.fullmatch(question)
+        if match is None:
+            continue
+        *item, year = match.groups()
+        if item and (
+            _NESTED_YEAR_RE.search(item[0]) or _NOT_AN_ITEM_RE.search(item[0])
+        ):
+            return None
+        return template.format(year=int(year)), tuple(item)
+    return None
+
+# Returns (sql, cache_key). cache_key is set only for freshly generated SQL;
+# pass it to cache_generated_sql once the SQL has executed successfully, so
+# a broken query is never cached.
+def generate_sql(question, schema_json, schema_hash):
+    client = get_openai_client()
+
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": f"Schema: {schema_json}"},
+        {
+            "role": "user",
+            "content": (
+                f"Question: {question}\n"
+                "Return only a valid Fabric SQL query. No markdown."
+            )
+        }
+    ]
+
+    # SYSTEM_PROMPT is constant and the schema is covered by its precomputed
+    # hash, so only the question needs hashing here.
+    cache_key = hashlib.blake2b(
+        (schema_hash + "\x00" + messages[-1]["content"]).encode(),
+        digest_size=16
+    ).hexdigest()
+    with _PROMPT_CACHE_LOCK:
+        cached_sql = _PROMPT_CACHE.get(cache_key)
+    if cached_sql is not None:
+        return cached_sql, None
+
     response = client.chat.completions.create(
         model="gpt-4o-mini",
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
-        ],
+        messages=messages,
         temperature=0
     )
 
-    return (
-        response.choices[0].message.content
-        .replace("```sql", "")
-        .replace("```", "")
-        .replace("`", "")
-        .strip()
-    )
+    sql = _FENCE_RE.sub("", response.choices[0].message.content).strip()
+    return sql, cache_key
+
+def cache_generated_sql(cache_key, sql):
+    if cache_key is None:
+        return
+    with _PROMPT_CACHE_LOCK:
+        _PROMPT_CACHE[cache_key] = sql
 
 # ---------------- EXECUTE SQL ----------------
-def execute_sql(sql, cursor):
-    cursor.execute(sql)
+# Rows are converted in batches so the full pyodbc row list and the list of
+# dicts are never held in memory at the same time.
+FETCH_BATCH_SIZE = 1000
+
+# 🔐 The RLS session context is set in the same batch as the generated query,
+# so both cost a single round-trip. SET NOCOUNT ON persists on the pooled
+# connection after the request; nothing here reads row counts.
+SET_SESSION_CONTEXT_SQL = """
+SET NOCOUNT ON;
+EXEC sys.sp_set_session_context @key=N'emailid', @value=?;
+"""
+
+def execute_sql(sql, cursor, email, params=()):
+    # Only the default row count for fetchmany(); pyodbc still calls
+    # SQLFetch once per row.
+    cursor.arraysize = FETCH_BATCH_SIZE
+    if params or "?" not in sql:
+        cursor.execute(SET_SESSION_CONTEXT_SQL + sql, (email, *params))
+    else:
+        # LLM SQL with a "?" (comment, identifier, literal) was never meant
+        # to be bound, so it runs unparameterized in its own batch.
+        cursor.execute(SET_SESSION_CONTEXT_SQL, (email,))
+        cursor.execute(sql)
+    while cursor.description is None and cursor.nextset():
+        pass
     cols = [c[0] for c in cursor.description]
-    return [dict(zip(cols, row)) for row in cursor.fetchall()]
+
+    result = []
+    while True:
+        rows = cursor.fetchmany()
+        if not rows:
+            break
+        result.extend(map(dict, map(zip, repeat(cols), rows)))
+    return result
+
+# ---------------- SEMANTIC CACHE ----------------
+# Reuses the SQL and result of a previous question when the new question's
+# embedding is close enough. Entries are namespaced per (emailid, schema) so
+# one user's RLS-filtered rows are never served to another.
+#
+# Off unless SEMANTIC_CACHE_ENABLED is set, since it needs an embedding
+# deployment (AZURE_OPENAI_EMBEDDING_MODEL) next to the chat model.
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "").lower() in ("1", "true", "yes")
+EMBEDDING_MODEL = os.getenv("AZURE_OPENAI_EMBEDDING_MODEL", "text-embedding-3-small")
+
+# Questions that differ only in a year or an item name embed very closely,
+# so a hit also requires the same literal slots: every word outside this
+# small filler vocabulary (numbers, item names, measures such as sales or
+# stock), in order. "a" is deliberately left out so "Widget A" and "Widget"
+# stay distinct.
+_SLOT_TOKEN_RE = re.compile(r"[\w.-]+(?:'\w+)?")
+# Only words that can never change the SQL belong here; "how many/much",
+# "to/from", "and/or" and "by" all do.
+_NON_SLOT_WORDS = frozenset("""
+an the of for in during
+what what's whats is was were are show me give get tell please
+total overall
+""".split())
+
+def question_slots(question):
+    return tuple(
+        tok for tok in (t.lower() for t in _SLOT_TOKEN_RE.findall(question))
+        if tok not in _NON_SLOT_WORDS
+    )
+
+class SemanticCache:
+    def __init__(self, threshold=0.92, ttl_seconds=300, max_keys=1024,
+                 max_entries=4, max_rows=FETCH_BATCH_SIZE):
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        # Large results are not cached; with one cache per gunicorn worker
+        # they would dominate memory for little benefit.
+        self.max_rows = max_rows
+        # Bounded across all users; each key holds a few paraphrases of one
+        # question, so the similarity scan stays short.
+        self._entries = TTLCache(maxsize=max_keys, ttl=ttl_seconds)
+        self._lock = threading.Lock()
+
+    def lookup(self, namespace, slots, vec):
+        now = time.monotonic()
+        with self._lock:
+            entries = list(self._entries.get((namespace, slots), ()))
+
+        best, best_score = None, self.threshold
+        for cached_vec, payload, ts in entries:
+            if now - ts >= self.ttl_seconds:
+                continue
+            score = sum(a * b for a, b in zip(vec, cached_vec))
+            if score >= best_score:
+                best, best_score = payload, score
+        return best
+
+    def add(self, namespace, slots, vec, payload):
+        if len(payload["result"]) > self.max_rows:
+            return
+
+        key = (namespace, slots)
+        with self._lock:
+            entries = list(self._entries.get(key, ()))
+            entries.append((vec, payload, time.monotonic()))
+            self._entries[key] = entries[-self.max_entries:]
+
+semantic_cache = SemanticCache(
+    threshold=float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92")),
+    ttl_seconds=int(os.getenv("SEMANTIC_CACHE_TTL_SECONDS", "300"))
+)
+
+# One embedding slot per gunicorn request thread (see gunicorn.conf.py), so
+# requests never queue behind each other for the overlap.
+_EMBED_POOL = ThreadPoolExecutor(
+    max_workers=int(os.getenv("GUNICORN_THREADS", "8"))
+)
+
+def embed(text):
+    response = get_openai_client().embeddings.create(
+        model=EMBEDDING_MODEL,
+        input=text
+    )
+    vec = response.data[0].embedding
+    norm = math.sqrt(sum(x * x for x in vec)) or 1.0
+    # float32 array: ~6 KB per 1536-dim vector instead of ~50 KB of floats.
+    return array("f", (x / norm for x in vec))
 
 # ---------------- HEALTH CHECK ----------------
 @app.route("/health", methods=["GET"])
@@ -168,9 +511,11 @@ def health():
 # ---------------- MAIN API ----------------
 @app.route("/query", methods=["POST","GET"])
 def query():
+    conn = None
+    reusable = True
     try:
         data = request.get_json(force=True)
-        print("Incoming data:", data)
+        logger.debug("Incoming data: %s", data)
 
         question = data.get("question")
         email = data.get("emailid")
@@ -180,39 +525,72 @@ def query():
                 "error": "Both 'question' and 'emailid' are required"
             }), 400
 
-        conn = get_db_connection()
+        # Canonical questions are answered from a local template: no LLM,
+        # no schema and no semantic cache.
+        template = match_template(question)
+
+        # The embedding call doesn't touch the DB, so it runs while this
+        # thread checks out a connection and loads the schema.
+        embed_future = None
+        if template is None and SEMANTIC_CACHE_ENABLED:
+            embed_future = _EMBED_POOL.submit(embed, question)
+
+        conn = acquire_db_connection()
         cursor = conn.cursor()
 
-        # 🔐 Set RLS context
-        cursor.execute("""
-            EXEC sys.sp_set_session_context
-                @key=N'emailid',
-                @value=?
-        """, (email,))
+        logger.debug("Session email: %s", email)
 
-        cursor.execute("SELECT SESSION_CONTEXT(N'emailid')")
-        print("Session email:", cursor.fetchone())
+        question_vec = None
+        if template is not None:
+            sql, params = template
+            cache_key = None
+        else:
+            schema, schema_hash = get_cached_schema(cursor)
+            namespace = (email, schema_hash)
+            slots = question_slots(question)
 
-        schema = get_schema_info(cursor)
+            if embed_future is not None:
+                try:
+                    question_vec = embed_future.result()
+                except Exception:
+                    logger.exception("Embedding failed; skipping semantic cache")
 
-        sql = generate_sql(question, schema)
-        print("Generated SQL:", sql)
+            if question_vec is not None:
+                cached = semantic_cache.lookup(namespace, slots, question_vec)
+                if cached is not None:
+                    return jsonify(cached)
 
-        result = execute_sql(sql, cursor)
+            sql, cache_key = generate_sql(question, schema, schema_hash)
+            params = ()
+        logger.debug("Generated SQL: %s", sql)
 
-        return jsonify({
+        result = execute_sql(sql, cursor, email, params)
+        cache_generated_sql(cache_key, sql)
+
+        payload = {
             "sql": sql,
             "result": result
-        })
+        }
+        if question_vec is not None:
+            semantic_cache.add(namespace, slots, question_vec, payload)
+
+        return jsonify(payload)
 
     except Exception as e:
-        import traceback
-        traceback.print_exc()
+        logger.exception("Query failed")
+        # Only DB errors can leave the connection in a bad state.
+        if isinstance(e, pyodbc.Error):
+            reusable = False
 
         return jsonify({
             "error": str(e)
         }), 500
 
+    finally:
+        if conn is not None:
+            release_db_connection(conn, reusable)
+
 
+# Production runs under gunicorn (see gunicorn.conf.py); this is for local use.
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=8000)
@@ -0,0 +1,20 @@
+import multiprocessing
+import os
+
+# Picked up automatically by `gunicorn app:app` (the App Service default).
+#
+# Requests are IO-bound (AAD, Azure OpenAI, Azure SQL), so each worker runs
+# a thread pool. gthread is used instead of gevent: pyodbc is a C extension
+# whose blocking calls are not made cooperative by gevent's monkey patching.
+#
+# Threads carry the concurrency; workers stay few because each one holds its
+# own DB pool, schema cache, semantic cache and embedding pool, and
+# cpu_count() can report a large number on App Service.
+#
+# Keep threads <= DB_POOL_SIZE (app.py). The database sees up to
+# workers * DB_POOL_SIZE * instances connections.
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+worker_class = "gthread"
+workers = int(os.getenv("GUNICORN_WORKERS", min(multiprocessing.cpu_count() + 1, 4)))
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+timeout = 600